@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 from DeviceConfig import DeviceConfig
 from Modbus import ModbusClient, ModbusReadMessage, ModbusRegister
+from Profiler import Profiler, ProfilerPhase
+from SubscriberDispatcher import OverflowPolicy, SubscriberDispatcher
 import Constants
 
 from InfluxDbSubscriber import InfluxDbSubscriber
@@ -10,6 +12,7 @@ from configparser import ConfigParser, NoOptionError, NoSectionError
 from pubsub import pub
 import getopt
 import sched
+import signal
 import sys
 import time
 
@@ -39,9 +42,13 @@ class Application:
       device_config_path: Path to the device config
       verbose: Whether verbose output is enabled
       _config: DeviceConfig instance used by application
+      _dispatcher: SubscriberDispatcher instance running the subscribers
       _modbus: ModbusClient instance used by application
       _modbus_messages: List of Modbus messages to send on every iteration
+      _profiler: Profiler instance used by application
+      _report_interval: Seconds between subscriber reports, 0 to disable
       _scheduler: Scheduler instance used by application
+      _stop_requested: Whether SIGTERM has been received
       _starttime: Start time of application.
     """
     def __init__(self, app_name, argv):
@@ -57,13 +64,14 @@ class Application:
         self.app_name = app_name
         self.config_path = '/etc/modbus-monitor.conf'
         self.device_config_path = None
+        self.profile = False
         self.serial_device = None
         self.slave_addr = None
         self.verbose = False
 
         # Get command-line options
         try:
-            opts, args = getopt.getopt(argv, 'ha:c:d:s:v', ['help', 'config=', 'device-config=', 'slave-address=', 'serial-device=', 'verbose'])
+            opts, args = getopt.getopt(argv, 'ha:c:d:ps:v', ['help', 'config=', 'device-config=', 'profile', 'slave-address=', 'serial-device=', 'verbose'])
         except getopt.GetoptError:
             self.print_help()
             sys.exit(2)
@@ -77,6 +85,8 @@ class Application:
                 self.config_path = arg
             elif opt in ('-d', '--device-config'):
                 self.device_config_path = arg
+            elif opt in ('-p', '--profile'):
+                self.profile = True
             elif opt in ('-s', '--serial-device'):
                 self.serial_device = arg
             elif opt in ('-v', '--verbose'):
@@ -95,6 +105,8 @@ class Application:
             self.slave_addr = int(config.get_setting('modbus', 'address'))
         if self.serial_device == None and config.get_setting('modbus', 'serial') != None:
             self.serial_device = config.get_setting('modbus', 'serial')
+        if config.get_setting('profiler', 'enabled') == True:
+            self.profile = True
         
         # Check that configuration is valid
         if self.device_config_path == None:
@@ -116,14 +128,32 @@ class Application:
             print('    Device Config File: {}'.format(self.device_config_path))
             print('    Modbus Address: {}'.format(self.slave_addr))
             print('    Modbus Device: {}'.format(self.serial_device))
+            print('    Profiler: {}'.format(self.profile))
             print('--------------')
 
-        # Initialize Subscribers
-        self._subscribers = []
+        # Initialize Profiler, toggled at runtime with SIGUSR1
+        profiler_rate = 100
+        if config.get_setting('profiler', 'rate') != None:
+            profiler_rate = int(config.get_setting('profiler', 'rate'))
+        if profiler_rate < 1:
+            print('Error: invalid profiler rate ({})'.format(profiler_rate))
+            sys.exit(1)
+        profiler_output = '/tmp'
+        if config.get_setting('profiler', 'output') != None:
+            profiler_output = config.get_setting('profiler', 'output')
+        self._profiler = Profiler(profiler_rate, profiler_output, self.verbose)
+        signal.signal(signal.SIGUSR1, self._profiler.request_toggle)
+
+        # Stop through run() on SIGTERM, so that the profile is written
+        self._stop_requested = False
+        signal.signal(signal.SIGTERM, self._request_stop)
+
+        # Initialize Subscribers, each running in a worker of its own
+        self._dispatcher = SubscriberDispatcher()
         if config.get_setting('subscribers', 'print') == True:
-            self._subscribers.append(PrintSubscriber(self.verbose))
+            self._add_subscriber(config, 'print', PrintSubscriber(self.verbose))
         if config.get_setting('subscribers', 'influxdb') == True:
-            self._subscribers.append(InfluxDbSubscriber(
+            self._add_subscriber(config, 'influxdb', InfluxDbSubscriber(
                 config.get_setting('influxdb', 'host'),
                 config.get_setting('influxdb', 'port'),
                 config.get_setting('influxdb', 'user'),
@@ -131,6 +161,9 @@ class Application:
                 config.get_setting('influxdb', 'database'),
                 config.get_setting('influxdb', 'measurement'),
                 self.verbose))
+        self._report_interval = 0
+        if config.get_setting('subscribers', 'report_interval') != None:
+            self._report_interval = int(config.get_setting('subscribers', 'report_interval'))
 
         # Load the Device Config file
         self._config = DeviceConfig(self.device_config_path, verbose=self.verbose)
@@ -143,6 +176,8 @@ class Application:
         self._scheduler = sched.scheduler(time.time, time.sleep)
         self._starttime = time.time()
         self._schedule(1, 1, self._event_read_modbus)
+        if self._report_interval > 0:
+            self._schedule(self._report_interval, 2, self._event_report_subscribers)
     
     def print_help(self):
         """Print application's help text
@@ -156,11 +191,58 @@ class Application:
         print('        Path to device config (.trio) that describe device being monitored')
         print('    -h / --help')
         print('        Shows this help text')
+        print('    -p / --profile')
+        print('        Start with the sampling profiler enabled (toggle at runtime with SIGUSR1)')
         print('    -s / --serial-device=')
         print('        Serial device to use for Modbus communication')
         print('    -v / --verbose=')
         print('        Verbose output from application')
     
+    def _add_subscriber(self, config, name, subscriber):
+        """Adds a subscriber to the dispatcher
+
+        Queue size and overflow policy are read from the config section
+        with the same name as the subscriber.
+
+        Args:
+          config:
+            ConfigFile to read the subscriber settings from
+          name:
+            Name of the subscriber and its config section
+          subscriber:
+            Subscriber object to add
+        """
+        queue_size = 256
+        if config.get_setting(name, 'queue_size') != None:
+            queue_size = int(config.get_setting(name, 'queue_size'))
+        if queue_size < 1:
+            print('Error: invalid queue size for {} ({})'.format(name, queue_size))
+            sys.exit(1)
+        policy = OverflowPolicy.DROP_OLDEST
+        if config.get_setting(name, 'overflow') != None:
+            try:
+                policy = OverflowPolicy(config.get_setting(name, 'overflow'))
+            except ValueError:
+                print('Error: invalid overflow policy for {} ({})'.format(name, config.get_setting(name, 'overflow')))
+                sys.exit(1)
+        if policy == OverflowPolicy.COALESCE and config.get_setting(name, 'queue_size') != None:
+            print('Warning: queue_size is ignored for {} with the coalesce policy'.format(name))
+        timeout = 1.0
+        if config.get_setting(name, 'block_timeout') != None:
+            timeout = float(config.get_setting(name, 'block_timeout'))
+        if timeout <= 0:
+            print('Error: invalid block timeout for {} ({})'.format(name, timeout))
+            sys.exit(1)
+        self._dispatcher.add_subscriber(subscriber, name, queue_size, policy, timeout)
+
+    def _request_stop(self, *args):
+        """Requests the application to stop after the current poll cycle
+
+        Only sets a flag, so it is safe to use directly as a signal
+        handler. Takes and ignores the signal handler arguments.
+        """
+        self._stop_requested = True
+
     def _schedule(self, interval, priority, action, argument=(), kwargs={}):
         """Schedule an event to happen at a certain interval
 
@@ -187,7 +269,16 @@ class Application:
     def run(self):
         """Runs the application
         """
-        self._scheduler.run()
+        self._dispatcher.start()
+        for worker in self._dispatcher.workers:
+            self._profiler.add_worker(worker)
+        if self.profile:
+            self._profiler.start()
+        try:
+            self._scheduler.run()
+        finally:
+            self._profiler.stop()
+            self._dispatcher.stop()
 
     def _event_read_modbus(self):
         """Event for reading data over Modbus
@@ -195,7 +286,9 @@ class Application:
         Loops through all Modbus messages needed to read the device
         data and prints the received data.
         """
+        profiler = self._profiler
         for message in self._modbus_messages:
+            profiler.phase = ProfilerPhase.BUS_IO
             response = None
             if message.reg_type == ModbusRegister.INPUT:
                 response = self._modbus.read_input_registers(message.start, message.count)
@@ -204,21 +297,46 @@ class Application:
             else:
                 print('Error: Unknown modbus register type')
             
+            profiler.phase = ProfilerPhase.DECODE
             if response.isError():
                 print(rr.error())
             else:
                 reg_id = message.start
                 for reg_value in response.registers:
+                    profiler.phase = ProfilerPhase.DECODE
                     # Handle Uint16 to Int16 conversion
                     if reg_value > 32767:
                         reg_value = reg_value - 65536
                     entity = self._config.get_entity(message.reg_type, reg_id)
                     if entity.set_value(reg_value):
+                        profiler.phase = ProfilerPhase.DISPATCH
                         pub.sendMessage(Constants.VALUECHANGED_TOPIC, entity=entity)
                     reg_id += 1
         
         # Notify that reading is done
+        profiler.phase = ProfilerPhase.DISPATCH
         pub.sendMessage(Constants.ITERATION_TOPIC)
+        profiler.phase = ProfilerPhase.IDLE
+
+        # Start or stop profiling if requested with SIGUSR1
+        profiler.poll()
+
+        # Stop if requested with SIGTERM, run() then returns normally
+        if self._stop_requested:
+            for event in self._scheduler.queue:
+                self._scheduler.cancel(event)
+            return
         
         # Reschedule this function
         self._schedule(1, 1, self._event_read_modbus)
+
+    def _event_report_subscribers(self):
+        """Event for reporting subscriber statistics
+
+        Prints lag, drop count and processing time of every subscriber.
+        """
+        for worker in self._dispatcher.workers:
+            print(worker)
+
+        # Reschedule this function
+        self._schedule(self._report_interval, 2, self._event_report_subscribers)
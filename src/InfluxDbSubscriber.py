@@ -1,15 +1,9 @@
-import Constants
-
 from datetime import datetime
-from pubsub import pub
 from collections import defaultdict
 from influxdb import InfluxDBClient
 
 class InfluxDbSubscriber:
     def __init__(self, host, port, user, password, db, measurement, verbose):
-        pub.subscribe(self.valueChanged, Constants.VALUECHANGED_TOPIC)
-        pub.subscribe(self.valueReadFinished, Constants.ITERATION_TOPIC)
-
         self._hasChanged = False
         self._measurement = measurement
         self._values = { }
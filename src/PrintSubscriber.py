@@ -1,10 +1,5 @@
-import Constants
-
-from pubsub import pub
-
 class PrintSubscriber:
     def __init__(self, verbose):
-        pub.subscribe(self.valueChanged, Constants.VALUECHANGED_TOPIC)
         if verbose:
             print('Print subscriber inited ...')
 
@@ -0,0 +1,205 @@
+import os
+import sys
+import threading
+import time
+
+class ProfilerPhase:
+    """Phases of a poll cycle that samples are attributed to"""
+    IDLE = 'idle'
+    BUS_IO = 'bus_io'
+    DECODE = 'decode'
+    DISPATCH = 'dispatch'
+    SUBSCRIBER = 'subscriber'
+
+class Profiler:
+    """Sampling profiler for the poll thread
+
+    Samples the stack of the poll thread at a fixed rate from a
+    separate thread and aggregates the samples per poll cycle phase.
+    The poll loop only has to update the `phase` attribute, so the
+    cost while the profiler is disabled is a single attribute store.
+
+    Samples are written as collapsed stacks (one `frame;frame;... count`
+    line per unique stack), which is the format accepted by
+    flamegraph.pl, inferno and speedscope. The phase is used as the
+    root frame. Subscriber workers added with add_worker() are sampled
+    as well and grouped under `subscriber;<name>`. Workers waiting for
+    events are counted under `subscriber;<name>;idle` without walking
+    their stack.
+
+    Attributes:
+      phase: Current phase of the poll thread (ProfilerPhase)
+      enabled: Whether sampling is currently running
+      output_dir: Directory where collapsed-stack files are written
+      rate: Sampling rate in Hz
+      verbose: Whether verbose output is enabled
+      _samples: Dictionary of collapsed stack to number of samples
+      _toggle_requested: Whether request_toggle() has been called since
+                         the last call to poll()
+      _write_count: Number of files written, used to make file names unique
+      _workers: List of (worker, root frame) tuples of subscriber workers
+      _thread: Sampler thread, None when disabled
+      _thread_id: Thread identifier of the poll thread
+      _stop_event: Event used to stop the sampler thread
+    """
+    def __init__(self, rate=100, output_dir='/tmp', verbose=False):
+        """Sets up the profiler for the calling thread
+
+        Args:
+          rate:
+            Sampling rate in Hz (int)
+          output_dir:
+            Directory to write collapsed-stack files to (string)
+          verbose:
+            Whether to enable verbose output (boolean)
+        """
+        self.phase = ProfilerPhase.IDLE
+        self.enabled = False
+        self.output_dir = output_dir
+        self.rate = rate
+        self.verbose = verbose
+        self._samples = { }
+        self._toggle_requested = False
+        self._write_count = 0
+        self._workers = [ ]
+        self._thread = None
+        self._thread_id = threading.get_ident()
+        self._stop_event = threading.Event()
+
+    def add_worker(self, worker):
+        """Register a subscriber worker to sample
+
+        Args:
+          worker:
+            Started SubscriberWorker instance
+        """
+        self._workers.append((worker, '{};{}'.format(ProfilerPhase.SUBSCRIBER, worker.name)))
+
+    def start(self):
+        """Starts sampling the poll thread
+        """
+        if self.enabled:
+            return
+        self.enabled = True
+        self._samples = { }
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        if self.verbose:
+            print('Profiler started ({} Hz)'.format(self.rate))
+
+    def stop(self):
+        """Stops sampling and writes the collected samples to file
+
+        Returns:
+          Path of the file written, or None if nothing was written
+        """
+        if not self.enabled:
+            return None
+        self.enabled = False
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        path = self.write()
+        if self.verbose:
+            print('Profiler stopped')
+        return path
+
+    def toggle(self):
+        """Toggles sampling on or off
+        """
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def request_toggle(self, *args):
+        """Requests sampling to be toggled on the next call to poll()
+
+        Only sets a flag, so it is safe to use directly as a signal
+        handler. Takes and ignores the signal handler arguments.
+        """
+        self._toggle_requested = True
+
+    def poll(self):
+        """Toggles sampling if requested with request_toggle()
+
+        Should be called regularly from the poll thread.
+        """
+        if self._toggle_requested:
+            self._toggle_requested = False
+            self.toggle()
+
+    def write(self):
+        """Writes the collected samples as a collapsed-stack file
+
+        Returns:
+          Path of the file written, or None if there were no samples
+        """
+        if len(self._samples) == 0:
+            return None
+        self._write_count += 1
+        path = os.path.join(self.output_dir,
+                            'modbus-monitor-{}-{}-{}.folded'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                                                    os.getpid(),
+                                                                    self._write_count))
+        try:
+            with open(path, 'x') as file:
+                for stack, count in sorted(self._samples.items()):
+                    file.write('{} {}\n'.format(stack, count))
+        except OSError as e:
+            print('Error: unable to write profile ({})'.format(e))
+            return None
+        print('Profile written to {}'.format(path))
+        return path
+
+    def _run(self):
+        """Sampler thread main loop
+        """
+        interval = 1.0 / self.rate
+        while not self._stop_event.wait(interval):
+            phase = self.phase
+            frames = sys._current_frames()
+            self._sample(phase, frames.get(self._thread_id))
+            for worker, root in self._workers:
+                if worker.busy:
+                    self._sample(root, frames.get(worker.thread_id))
+                else:
+                    idle = root + ';' + ProfilerPhase.IDLE
+                    self._samples[idle] = self._samples.get(idle, 0) + 1
+
+    def _sample(self, root, frame):
+        """Adds a sample of a thread to the collected samples
+
+        Args:
+          root:
+            Root frame to put the stack under
+          frame:
+            Innermost frame of the sampled thread, None if the thread
+            is not running
+        """
+        if frame is None:
+            return
+        stack = self._collapse(root, frame)
+        self._samples[stack] = self._samples.get(stack, 0) + 1
+
+    def _collapse(self, root, frame):
+        """Builds a collapsed stack string from a frame
+
+        Args:
+          root:
+            Root frame to put the stack under
+          frame:
+            Innermost frame of the sampled thread
+
+        Returns:
+          Stack as a semicolon separated string, root first
+        """
+        frames = [ ]
+        while frame is not None:
+            code = frame.f_code
+            frames.append('{} ({})'.format(code.co_name, os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        frames.append(root)
+        frames.reverse()
+        return ';'.join(frames)
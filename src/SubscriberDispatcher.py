@@ -0,0 +1,404 @@
+import Constants
+
+from enum import Enum
+from pubsub import pub
+import copy
+import threading
+import time
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = 'drop-oldest'
+    COALESCE = 'coalesce'
+    BLOCK = 'block'
+    def __str__(self):
+        return self.value
+
+class SubscriberWorker:
+    """Runs a single subscriber in its own thread
+
+    A slow or failing subscriber only affects its own worker. How
+    events are queued depends on the overflow policy:
+
+      drop-oldest: Events are read from the ring buffer of the
+                   dispatcher using the worker's own cursor. If the
+                   worker falls more than `queue_size` events behind,
+                   the oldest events are skipped.
+      coalesce: The worker reads the latest value per entity from a
+                map shared by all coalesce workers, so no entity's last
+                change is ever lost. `queue_size` is not used, the
+                queue is bounded by the number of entities.
+      block: Like drop-oldest, but the poll thread waits up to
+             `timeout` seconds for space first. If the worker does not
+             make space in time it is marked as overflowed, and events
+             are dropped without waiting until it has caught up.
+
+    Attributes:
+      name: Name of the subscriber, used in reports
+      subscriber: Subscriber object receiving the events
+      policy: Overflow policy (enum OverflowPolicy)
+      queue_size: Maximum number of pending events
+      timeout: Seconds to block the poll thread with the block policy
+      seq: Sequence number of the next event to read
+      overflowed: Whether the worker timed out on space (block)
+      busy: Whether the worker is delivering an event
+      processed: Number of events delivered to the subscriber
+      errors: Number of exceptions raised by the subscriber
+      busy_time: Total time spent in the subscriber (seconds)
+      max_time: Longest time spent on a single event (seconds)
+      _dispatcher: SubscriberDispatcher the worker reads events from
+      _dropped: Number of events skipped or coalesced away when reading
+      _thread: Worker thread
+    """
+    def __init__(self, dispatcher, subscriber, name, queue_size, policy, timeout):
+        """Sets up the worker, the thread is started with start()
+
+        Args:
+          dispatcher:
+            SubscriberDispatcher to read events from
+          subscriber:
+            Subscriber object to deliver events to
+          name:
+            Name of the subscriber (string)
+          queue_size:
+            Maximum number of pending events (int)
+          policy:
+            Overflow policy (enum OverflowPolicy)
+          timeout:
+            Seconds to block with the block policy (float)
+        """
+        self.name = name
+        self.subscriber = subscriber
+        self.policy = policy
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.seq = 0
+        self.overflowed = False
+        self.busy = False
+        self.processed = 0
+        self._dropped = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.max_time = 0.0
+        self._dispatcher = dispatcher
+        self._thread = threading.Thread(target=self._run, name='subscriber-' + name, daemon=True)
+
+    @property
+    def lag(self):
+        """Number of events published but not yet read by the worker
+
+        Events that have already been overwritten in the ring buffer are
+        counted as dropped instead.
+        """
+        behind = self._dispatcher.head - self.seq
+        if self.policy == OverflowPolicy.COALESCE:
+            return behind
+        return min(behind, self.queue_size)
+
+    @property
+    def dropped(self):
+        """Number of events dropped or coalesced away
+
+        Includes events that have been overwritten in the ring buffer
+        but not yet skipped by the worker, so that a hung worker still
+        reports its drops.
+        """
+        if self.policy == OverflowPolicy.COALESCE:
+            return self._dropped
+        return self._dropped + max(0, self._dispatcher.head - self.seq - self.queue_size)
+
+    @property
+    def thread_id(self):
+        """Thread identifier of the worker thread, None if not started"""
+        return self._thread.ident
+
+    def start(self):
+        """Starts the worker thread
+        """
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """Waits for the worker thread to finish
+
+        Args:
+          timeout:
+            Maximum number of seconds to wait
+        """
+        self._thread.join(timeout)
+
+    def _run(self):
+        """Worker thread main loop
+        """
+        while True:
+            if self.policy == OverflowPolicy.COALESCE:
+                events = self._dispatcher.read_coalesced(self)
+            else:
+                events = self._dispatcher.read(self)
+            if events == None:
+                return
+            for topic, entity in events:
+                self._deliver(topic, entity)
+
+    def _deliver(self, topic, entity):
+        """Delivers a single event to the subscriber
+
+        Exceptions raised by the subscriber are printed and counted so
+        that they do not stop the worker.
+
+        Args:
+          topic:
+            Topic of the event (Constants.VALUECHANGED_TOPIC or
+            Constants.ITERATION_TOPIC)
+          entity:
+            Entity for value changes, None for iteration events
+        """
+        self.busy = True
+        start = time.monotonic()
+        try:
+            if topic == Constants.VALUECHANGED_TOPIC:
+                self.subscriber.valueChanged(entity)
+            elif hasattr(self.subscriber, 'valueReadFinished'):
+                self.subscriber.valueReadFinished()
+        except Exception as e:
+            self.errors += 1
+            print('Error: subscriber {} failed ({})'.format(self.name, e))
+        elapsed = time.monotonic() - start
+        self.processed += 1
+        self.busy_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        self.busy = False
+
+    def __str__(self):
+        avg_time = self.busy_time / self.processed if self.processed > 0 else 0.0
+        return '{} Subscriber (policy:{})(lag:{})(processed:{})(dropped:{})(errors:{})(avg:{:.1f} ms)(max:{:.1f} ms)'.format(
+            self.name,
+            self.policy,
+            self.lag,
+            self.processed,
+            self.dropped,
+            self.errors,
+            avg_time * 1000,
+            self.max_time * 1000)
+
+class SubscriberDispatcher:
+    """Fans out published events to subscriber workers
+
+    The dispatcher is the only listener of the pubsub topics. Every
+    event is stored once in a shared ring buffer, and value changes
+    are also stored once in a map of the latest change per entity.
+    Each worker reads with its own cursor, so publishing costs the
+    same no matter how many subscribers are configured. Workers using
+    the block policy are only checked one by one when the oldest
+    cursor among them is close to a full queue.
+
+    Entities are copied when published, so a worker that is behind
+    still sees the value the entity had when it changed.
+
+    Attributes:
+      workers: List of SubscriberWorker instances
+      head: Sequence number of the next event to publish
+      _slots: Ring buffer of (topic, entity) tuples
+      _latest: Dictionary of entity id to (seq, event) of the latest change
+      _iteration_seq: Sequence number of the latest iteration event
+      _blocking: Workers using the block policy
+      _block_floor: Lowest cursor among block workers that are not
+                    overflowed, may be lower than the actual cursors
+      _block_size: Smallest queue size among block workers
+      _coalescing: Workers using the coalesce policy
+      _running: Whether workers should keep waiting for events
+      _lock: Lock protecting the ring buffer and cursors
+      _not_empty: Condition notified when an event is published
+      _not_full: Condition notified when a worker reads an event
+    """
+    def __init__(self):
+        """Sets up the dispatcher and subscribes to the pubsub topics
+        """
+        self.workers = [ ]
+        self.head = 0
+        self._slots = [ ]
+        self._latest = { }
+        self._iteration_seq = -1
+        self._blocking = [ ]
+        self._block_floor = 0
+        self._block_size = None
+        self._coalescing = [ ]
+        self._running = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        pub.subscribe(self.valueChanged, Constants.VALUECHANGED_TOPIC)
+        pub.subscribe(self.valueReadFinished, Constants.ITERATION_TOPIC)
+
+    def add_subscriber(self, subscriber, name, queue_size=256, policy=OverflowPolicy.DROP_OLDEST, timeout=1.0):
+        """Adds a subscriber with a worker of its own
+
+        Must be called before start().
+
+        Args:
+          subscriber:
+            Subscriber object, must implement valueChanged(entity) and
+            may implement valueReadFinished()
+          name:
+            Name of the subscriber (string)
+          queue_size:
+            Maximum number of pending events, at least 1 (int)
+          policy:
+            Overflow policy (enum OverflowPolicy)
+          timeout:
+            Seconds to block with the block policy, above 0 (float)
+
+        Returns:
+          The SubscriberWorker created for the subscriber
+        """
+        worker = SubscriberWorker(self, subscriber, name, queue_size, policy, timeout)
+        self.workers.append(worker)
+        if policy == OverflowPolicy.COALESCE:
+            self._coalescing.append(worker)
+            return worker
+        if policy == OverflowPolicy.BLOCK:
+            self._blocking.append(worker)
+            if self._block_size == None or queue_size < self._block_size:
+                self._block_size = queue_size
+        if queue_size > len(self._slots):
+            self._slots = [None] * queue_size
+        return worker
+
+    def start(self):
+        """Starts all worker threads
+        """
+        self._running = True
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, timeout=5.0):
+        """Stops all worker threads
+
+        Workers deliver the events still pending before they exit.
+
+        Args:
+          timeout:
+            Maximum number of seconds to wait for each worker
+        """
+        with self._lock:
+            self._running = False
+            self._not_empty.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def valueChanged(self, entity):
+        if len(self.workers) == 0:
+            return
+        self._publish((Constants.VALUECHANGED_TOPIC, copy.copy(entity)))
+
+    def valueReadFinished(self):
+        if len(self.workers) == 0:
+            return
+        self._publish((Constants.ITERATION_TOPIC, None))
+
+    def _publish(self, event):
+        """Stores an event for the workers and wakes them
+
+        Args:
+          event:
+            (topic, entity) tuple
+        """
+        topic, entity = event
+        with self._lock:
+            if len(self._slots) > 0:
+                if len(self._blocking) > 0 and self.head - self._block_floor >= self._block_size:
+                    # Releases the lock while waiting, so store nothing before
+                    self._wait_for_space()
+                self._slots[self.head % len(self._slots)] = event
+            if len(self._coalescing) > 0:
+                if topic == Constants.VALUECHANGED_TOPIC:
+                    self._latest[entity.id] = (self.head, event)
+                else:
+                    self._iteration_seq = self.head
+            self.head += 1
+            self._not_empty.notify_all()
+
+    def _wait_for_space(self):
+        """Waits for the block policy workers to make space
+
+        Each worker waits until its own timeout, counted from the start
+        of the publish, so the poll thread is never held longer than the
+        longest timeout per event. A worker that does not make space in
+        time is marked as overflowed and is not waited for until it has
+        caught up. Must be called with the lock held.
+        """
+        start = time.monotonic()
+        for worker in self._blocking:
+            if worker.overflowed:
+                continue
+            deadline = start + worker.timeout
+            while self.head - worker.seq >= worker.queue_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    worker.overflowed = True
+                    print('Error: subscriber {} is not keeping up, dropping events'.format(worker.name))
+                    break
+                self._not_full.wait(remaining)
+        cursors = [worker.seq for worker in self._blocking if not worker.overflowed]
+        self._block_floor = min(cursors) if len(cursors) > 0 else self.head
+
+    def read(self, worker):
+        """Reads pending events for a worker, waiting if there are none
+
+        Events the worker is too far behind on are skipped and counted
+        as dropped.
+
+        Args:
+          worker:
+            SubscriberWorker to read events for
+
+        Returns:
+          List of (topic, entity) tuples, or None if the dispatcher
+          is stopped and there are no more events
+        """
+        with self._lock:
+            while worker.seq == self.head:
+                if not self._running:
+                    return None
+                self._not_empty.wait()
+            oldest = self.head - worker.queue_size
+            if worker.seq < oldest:
+                worker._dropped += oldest - worker.seq
+                worker.seq = oldest
+            event = self._slots[worker.seq % len(self._slots)]
+            worker.seq += 1
+            if worker.seq == self.head:
+                worker.overflowed = False
+            self._not_full.notify()
+            return [event]
+
+    def read_coalesced(self, worker):
+        """Reads the pending events of a coalesce policy worker
+
+        Waits if there are none.
+
+        Args:
+          worker:
+            SubscriberWorker to read events for
+
+        Returns:
+          List of (topic, entity) tuples with the latest value change
+          per entity, followed by an iteration event if one is pending.
+          None if the dispatcher is stopped and there are no more events
+        """
+        with self._lock:
+            while worker.seq == self.head:
+                if not self._running:
+                    return None
+                self._not_empty.wait()
+            latest = list(self._latest.values())
+            iteration_seq = self._iteration_seq
+            start = worker.seq
+            worker.seq = self.head
+
+        # Filter outside the lock, the poll thread only waits for the copy
+        events = [event for seq, event in latest if seq >= start]
+        if iteration_seq >= start:
+            events.append((Constants.ITERATION_TOPIC, None))
+        worker._dropped += worker.seq - start - len(events)
+        return events
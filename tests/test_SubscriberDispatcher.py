@@ -0,0 +1,119 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import Constants
+from SubscriberDispatcher import OverflowPolicy, SubscriberDispatcher
+
+class StubEntity:
+    def __init__(self, id, value):
+        self.id = id
+        self.value = value
+
+class StubSubscriber:
+    def __init__(self):
+        self.values = { }
+
+    def valueChanged(self, entity):
+        self.values[entity.id] = entity.value
+
+class TestBlockPolicy(unittest.TestCase):
+    def test_workers_use_own_timeout(self):
+        dispatcher = SubscriberDispatcher()
+        fast = dispatcher.add_subscriber(StubSubscriber(), 'fast', 2, OverflowPolicy.BLOCK, 0.1)
+        slow = dispatcher.add_subscriber(StubSubscriber(), 'slow', 2, OverflowPolicy.BLOCK, 0.5)
+
+        # Workers are not started, so the queues fill up after two events
+        dispatcher.valueChanged(StubEntity(0, 0))
+        dispatcher.valueChanged(StubEntity(1, 1))
+
+        start = time.monotonic()
+        thread = threading.Thread(target=dispatcher.valueChanged, args=(StubEntity(2, 2),))
+        thread.start()
+        time.sleep(0.3)
+        self.assertTrue(fast.overflowed)
+        self.assertFalse(slow.overflowed)
+        thread.join()
+        elapsed = time.monotonic() - start
+        self.assertTrue(slow.overflowed)
+        self.assertGreaterEqual(elapsed, 0.45)
+        self.assertLess(elapsed, 0.6)
+
+    def test_overflowed_worker_is_not_waited_for(self):
+        dispatcher = SubscriberDispatcher()
+        worker = dispatcher.add_subscriber(StubSubscriber(), 'hung', 1, OverflowPolicy.BLOCK, 0.1)
+
+        dispatcher.valueChanged(StubEntity(0, 0))
+        dispatcher.valueChanged(StubEntity(1, 1))
+        self.assertTrue(worker.overflowed)
+
+        start = time.monotonic()
+        for i in range(10):
+            dispatcher.valueChanged(StubEntity(i, i))
+        self.assertLess(time.monotonic() - start, 0.05)
+
+class TestDropOldestPolicy(unittest.TestCase):
+    def test_hung_worker_reports_drops(self):
+        dispatcher = SubscriberDispatcher()
+        worker = dispatcher.add_subscriber(StubSubscriber(), 'hung', 2)
+
+        for i in range(6):
+            dispatcher.valueChanged(StubEntity(i, i))
+        self.assertEqual(worker.lag, 2)
+        self.assertEqual(worker.dropped, 4)
+
+        # Skipping the overwritten events does not count them twice
+        events = dispatcher.read(worker)
+        self.assertEqual([entity.id for topic, entity in events], [4])
+        self.assertEqual(worker.lag, 1)
+        self.assertEqual(worker.dropped, 4)
+
+class TestCoalescePolicy(unittest.TestCase):
+    def test_latest_value_of_every_entity_is_kept(self):
+        dispatcher = SubscriberDispatcher()
+        worker = dispatcher.add_subscriber(StubSubscriber(), 'coalesce', 4, OverflowPolicy.COALESCE)
+
+        for i in range(20):
+            dispatcher.valueChanged(StubEntity(i, i))
+        dispatcher.valueChanged(StubEntity(3, 100))
+        dispatcher.valueReadFinished()
+
+        events = dispatcher.read_coalesced(worker)
+        values = {entity.id: entity.value for topic, entity in events[:-1]}
+        self.assertEqual(len(values), 20)
+        self.assertEqual(values[3], 100)
+        self.assertEqual(events[-1], (Constants.ITERATION_TOPIC, None))
+        self.assertEqual(worker.dropped, 1)
+
+    def test_only_changes_after_cursor_are_read(self):
+        dispatcher = SubscriberDispatcher()
+        worker = dispatcher.add_subscriber(StubSubscriber(), 'coalesce', 4, OverflowPolicy.COALESCE)
+
+        dispatcher.valueChanged(StubEntity(0, 0))
+        dispatcher.read_coalesced(worker)
+        dispatcher.valueChanged(StubEntity(1, 1))
+
+        events = dispatcher.read_coalesced(worker)
+        self.assertEqual([entity.id for topic, entity in events], [1])
+
+    def test_read_during_blocked_publish_delivers_once(self):
+        dispatcher = SubscriberDispatcher()
+        dispatcher.add_subscriber(StubSubscriber(), 'hung', 1, OverflowPolicy.BLOCK, 0.3)
+        worker = dispatcher.add_subscriber(StubSubscriber(), 'coalesce', 4, OverflowPolicy.COALESCE)
+
+        dispatcher.valueChanged(StubEntity(0, 0))
+        thread = threading.Thread(target=dispatcher.valueChanged, args=(StubEntity(1, 1),))
+        thread.start()
+        time.sleep(0.1)
+        first = dispatcher.read_coalesced(worker)
+        thread.join()
+        second = dispatcher.read_coalesced(worker)
+        self.assertEqual([entity.id for topic, entity in first], [0])
+        self.assertEqual([entity.id for topic, entity in second], [1])
+
+if __name__ == '__main__':
+    unittest.main()